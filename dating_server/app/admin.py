@@ -0,0 +1,18 @@
+﻿import os
+import hmac
+from typing import Optional
+from fastapi import Header, HTTPException
+
+# Единственный секрет для служебных эндпоинтов; передаётся в заголовке X-Admin-Token
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+
+def is_admin_token(value: Optional[str]) -> bool:
+    if not ADMIN_TOKEN or value is None:
+        return False
+    return hmac.compare_digest(value.encode(), ADMIN_TOKEN.encode())
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not is_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
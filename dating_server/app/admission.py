@@ -0,0 +1,118 @@
+﻿import os
+import time
+import threading
+from collections import Counter
+from fastapi import HTTPException
+
+# Лимиты одновременных запросов на маршрут. Всё, что сверх лимита, сразу получает 503,
+# а не встаёт в очередь к пулу потоков.
+ROUTE_CONCURRENCY = {
+    "/profiles": int(os.environ.get("LIMIT_PROFILES", "8")),
+    "/matches": int(os.environ.get("LIMIT_MATCHES", "16")),
+    "/register": int(os.environ.get("LIMIT_REGISTER", "4")),
+}
+
+# Ленту отбрасываем первой, когда сервер перегружен, чтобы чат продолжал работать.
+LOW_PRIORITY_ROUTES = {"/profiles", "/matches"}
+SHED_THRESHOLD = int(os.environ.get("SHED_THRESHOLD", "64"))
+RETRY_AFTER_SECONDS = 1
+
+shed_counters = Counter()
+
+
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}  # {key: (tokens, last_refill)}
+        self._prune_at = MAX_BUCKETS
+        # take вызывается из нескольких потоков пула одновременно
+        self._lock = threading.Lock()
+
+    def take(self, key) -> float:
+        """Забирает один токен. Возвращает 0, если можно продолжать, иначе сколько секунд ждать."""
+        return self.take_up_to(key, 1)[1]
+
+    def take_up_to(self, key, count: int):
+        """Забирает до count токенов. Возвращает (сколько выдано, сколько секунд ждать остальные)."""
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            granted = min(count, int(tokens))
+            tokens -= granted
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self._prune_at:
+                self.prune(now)
+            if granted == count:
+                return granted, 0
+            return granted, (1 - tokens) / self.rate
+
+    def prune(self, now: float):
+        full = [k for k, (t, last) in self.buckets.items() if t + (now - last) * self.rate >= self.capacity]
+        for k in full:
+            del self.buckets[k]
+        # Если почти все ключи активны, следующую чистку откладываем, чтобы не платить O(n) на каждом вызове
+        self._prune_at = max(MAX_BUCKETS, 2 * len(self.buckets))
+
+
+like_limiter = TokenBucket(rate=float(os.environ.get("RATE_LIKE", "2")), capacity=30)
+message_limiter = TokenBucket(rate=float(os.environ.get("RATE_MESSAGE", "5")), capacity=20)
+register_limiter = TokenBucket(rate=float(os.environ.get("RATE_REGISTER", "0.1")), capacity=3)
+
+
+def check_rate_limit(limiter: TokenBucket, key, name: str):
+    retry_after = limiter.take(key)
+    if retry_after:
+        shed_counters[f"rate_limit:{name}"] += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, round(retry_after)))},
+        )
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = 0
+        self.route_in_flight = Counter()
+
+    async def reject(self, send, route: str, reason: str):
+        shed_counters[f"{reason}:{route}"] += 1
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"retry-after", str(RETRY_AFTER_SECONDS).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": b'{"detail":"Server is busy"}'})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = scope["path"]
+        if route in LOW_PRIORITY_ROUTES and self.in_flight >= SHED_THRESHOLD:
+            await self.reject(send, route, "shed")
+            return
+        limit = ROUTE_CONCURRENCY.get(route)
+        if limit is not None and self.route_in_flight[route] >= limit:
+            await self.reject(send, route, "concurrency")
+            return
+
+        self.in_flight += 1
+        if limit is not None:
+            self.route_in_flight[route] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+            if limit is not None:
+                self.route_in_flight[route] -= 1
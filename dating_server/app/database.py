@@ -89,7 +89,7 @@ def load_likes():
     try:
         conn = get_connection()
         cur = conn.cursor()
-        cur.execute("SELECT from_user_id, to_user_id FROM likes")
+        cur.execute("SELECT from_user_id, to_user_id FROM likes WHERE is_like ORDER BY created_at, id")
         rows = cur.fetchall()
         for row in rows:
             from_id = row['from_user_id']
@@ -103,6 +103,21 @@ def load_likes():
         print(f"Error loading likes: {e}")
     return likes
 
+def load_skips():
+    skips = {}
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT from_user_id, to_user_id FROM likes WHERE NOT is_like")
+        rows = cur.fetchall()
+        for row in rows:
+            skips.setdefault(row['from_user_id'], set()).add(row['to_user_id'])
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f"Error loading skips: {e}")
+    return skips
+
 def load_matches():
     matches = {}
     try:
@@ -171,6 +186,23 @@ def update_user(user_id, user_data):
     except Exception as e:
         print(f"Error updating user: {e}")
 
+def update_locations(locations):
+    """locations: [(user_id, latitude, longitude, show_location)] — одной транзакцией"""
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        cur.executemany("""
+            UPDATE users SET latitude=%s, longitude=%s, show_location=%s
+            WHERE id=%s
+        """, [(lat, lon, show, user_id) for user_id, lat, lon, show in locations])
+        conn.commit()
+        cur.close()
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Error updating locations: {e}")
+        return False
+
 def save_like(from_user_id, to_user_id, is_like=True):
     try:
         conn = get_connection()
@@ -178,7 +210,7 @@ def save_like(from_user_id, to_user_id, is_like=True):
         cur.execute("""
             INSERT INTO likes (from_user_id, to_user_id, is_like)
             VALUES (%s, %s, %s)
-            ON CONFLICT DO NOTHING
+            ON CONFLICT (from_user_id, to_user_id) DO UPDATE SET is_like = EXCLUDED.is_like
         """, (from_user_id, to_user_id, is_like))
         conn.commit()
         cur.close()
@@ -201,5 +233,28 @@ def save_match(user1_id, user2_id):
     except Exception as e:
         print(f"Error saving match: {e}")
 
+def save_swipes(swipes, matches):
+    """swipes: [(from_user_id, to_user_id, is_like)], matches: [(user1_id, user2_id)] — одной транзакцией"""
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        if swipes:
+            cur.executemany("""
+                INSERT INTO likes (from_user_id, to_user_id, is_like)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (from_user_id, to_user_id) DO UPDATE SET is_like = EXCLUDED.is_like
+            """, swipes)
+        if matches:
+            cur.executemany("""
+                INSERT INTO matches (user1_id, user2_id)
+                VALUES (%s, %s)
+                ON CONFLICT DO NOTHING
+            """, [(min(u1, u2), max(u1, u2)) for u1, u2 in matches])
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f"Error saving swipes: {e}")
+
 if __name__ == "__main__":
     init_db()
@@ -1,18 +1,30 @@
-﻿from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Query
+﻿from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, UploadFile, File, Query, Request, Header
+from fastapi.responses import JSONResponse, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Literal
 from datetime import datetime
 import os
 import uuid
 import aiofiles
+import asyncio
 import math
-from app.database import load_users, load_likes, load_matches, save_user, save_like, save_match
+import time
+from app.database import load_users, load_likes, load_skips, load_matches, save_user, save_like, save_match, save_swipes, update_locations
+from app.profiling import install_profiler
+from app.admin import require_admin
+from app.state_log import StateLog, SNAPSHOT_INTERVAL
+from app.sync_log import ChangeLog, SELF
+from app.search_index import MessageIndex
+from app.admission import AdmissionMiddleware, check_rate_limit, like_limiter, message_limiter, register_limiter, shed_counters
 
 app = FastAPI(title="Dating App API")
 
+# Последний добавленный middleware — внешний: CORS должен оборачивать и ответы 503 от AdmissionMiddleware
+app.add_middleware(AdmissionMiddleware)
+install_profiler(app)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -29,6 +41,8 @@ security = HTTPBearer()
 
 users_db = {}
 likes_db = {}
+liked_by_db = {}  # {user_id: {liker_id: None}} — обратный индекс лайков, порядок как у лайков
+skips_db = {}  # {user_id: {skipped_user_ids}}
 matches_db = {}
 tokens_db = {}
 messages_db = {}
@@ -37,6 +51,9 @@ user_status = {}
 blocks_db = {}  # {user_id: [blocked_user_ids]}
 reports_db = []  # [{reporter_id, reported_id, reason, description, timestamp}]
 settings_db = {}  # {user_id: {settings}}
+state_log = StateLog()
+change_log = ChangeLog()
+message_index = MessageIndex()
 
 
 @app.on_event("startup")
@@ -55,6 +72,10 @@ def startup_load_data():
     loaded_likes = load_likes()
     for from_id, to_ids in loaded_likes.items():
         likes_db[from_id] = to_ids
+        for to_id in to_ids:
+            liked_by_db.setdefault(to_id, {})[from_id] = None
+
+    skips_db.update(load_skips())
 
     loaded_matches = load_matches()
     for user_id, match_ids in loaded_matches.items():
@@ -62,11 +83,109 @@ def startup_load_data():
 
     print(f"Loaded {len(users_db)} users")
 
+    state_log.load(restore_state, apply_state_op)
+    snapshot_report_keys.clear()
+    state_log.start()
+
     for uid, u in users_db.items():
         if u.get('latitude') and u.get('longitude'):
             print(f"  User {uid} ({u['name']}): {u['latitude']}, {u['longitude']}")
 
 
+@app.on_event("startup")
+async def start_state_snapshots():
+    async def snapshot_loop():
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                # Копирование идёт под блокировкой журнала, поэтому не на event loop
+                await asyncio.to_thread(state_log.snapshot, capture_state)
+            except Exception as e:
+                print(f"Error saving state snapshot: {e}")
+    asyncio.create_task(snapshot_loop())
+
+
+@app.on_event("startup")
+async def start_location_flush():
+    async def flush_loop():
+        while True:
+            await asyncio.sleep(LOCATION_FLUSH_INTERVAL)
+            await asyncio.to_thread(flush_locations)
+    asyncio.create_task(flush_loop())
+
+
+@app.on_event("shutdown")
+def shutdown_save_state():
+    flush_locations()
+    try:
+        state_log.snapshot(capture_state)
+    except Exception as e:
+        print(f"Error saving state snapshot: {e}")
+    finally:
+        state_log.close()
+
+
+# ==================== СОХРАНЕНИЕ СОСТОЯНИЯ ====================
+
+def capture_state() -> dict:
+    # Словари меняются из потоков пула; list(d.items()) копирует их за один вызов,
+    # без ошибки "dictionary changed size during iteration"
+    return {
+        "blocks": {uid: list(ids) for uid, ids in list(blocks_db.items())},
+        "settings": {uid: dict(s) for uid, s in list(settings_db.items())},
+        "reports": list(reports_db),
+        "tokens": {token: u["id"] for token, u in list(tokens_db.items())},
+        "user_status": {uid: dict(s) for uid, s in list(user_status.items())},
+    }
+
+
+def report_key(report: dict) -> tuple:
+    return (report["reporter_id"], report["reported_id"], report["timestamp"])
+
+
+# Ключи жалоб из снимка: запись журнала может повторять жалобу, уже попавшую в снимок
+snapshot_report_keys = set()
+
+
+def restore_state(state: dict):
+    blocks_db.update(state["blocks"])
+    settings_db.update(state["settings"])
+    reports_db.extend(state["reports"])
+    snapshot_report_keys.update(report_key(report) for report in state["reports"])
+    for token, uid in state["tokens"].items():
+        if uid in users_db:
+            tokens_db[token] = users_db[uid]
+    user_status.update(state["user_status"])
+    # После рестарта соединений нет, поэтому все офлайн
+    for status in user_status.values():
+        status["online"] = False
+
+
+def apply_state_op(op: tuple):
+    kind = op[0]
+    if kind == "block":
+        blocks_db.setdefault(op[1], [])
+        if op[2] not in blocks_db[op[1]]:
+            blocks_db[op[1]].append(op[2])
+    elif kind == "unblock":
+        if op[2] in blocks_db.get(op[1], []):
+            blocks_db[op[1]].remove(op[2])
+    elif kind == "blocks_clear":
+        blocks_db.pop(op[1], None)
+    elif kind == "settings":
+        settings_db[op[1]] = op[2]
+    elif kind == "report":
+        if report_key(op[1]) not in snapshot_report_keys:
+            reports_db.append(op[1])
+    elif kind == "token":
+        if op[2] in users_db:
+            tokens_db[op[1]] = users_db[op[2]]
+    elif kind == "token_del":
+        tokens_db.pop(op[1], None)
+    elif kind == "status":
+        user_status[op[1]] = {**op[2], "online": False}
+
+
 def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     R = 6371
     lat1_rad = math.radians(lat1)
@@ -112,6 +231,18 @@ class MessageSend(BaseModel):
     image_url: Optional[str] = None
 
 
+class SwipeAction(BaseModel):
+    user_id: int
+    action: Literal["like", "skip"]
+
+
+class SwipeBatch(BaseModel):
+    swipes: List[SwipeAction]
+
+
+MAX_SWIPES_PER_BATCH = 50
+
+
 class SettingsUpdate(BaseModel):
     push_notifications: Optional[bool] = None
     message_notifications: Optional[bool] = None
@@ -155,6 +286,79 @@ async def send_ws_message(user_id: int, message: dict):
             pass
 
 
+def add_message(sender_id: int, receiver_id: int, text: str, image_url: Optional[str]) -> dict:
+    chat_id = get_chat_id(sender_id, receiver_id)
+    if chat_id not in messages_db:
+        messages_db[chat_id] = []
+    new_message = {
+        "id": len(messages_db[chat_id]) + 1,
+        "sender_id": sender_id, "receiver_id": receiver_id,
+        "text": text, "image_url": image_url,
+        "timestamp": datetime.now().isoformat(), "is_read": False, "deleted": False
+    }
+    messages_db[chat_id].append(new_message)
+    change_log.record_pair(sender_id, receiver_id)
+    message_index.add(new_message)
+    return new_message
+
+
+def record_profile_change(user_id: int):
+    change_log.record(user_id, SELF)
+    for match_id in matches_db.get(user_id, []):
+        change_log.record(match_id, user_id)
+
+
+def record_presence_change(user_id: int):
+    # online и last_seen видны собеседникам в /matches
+    for match_id in matches_db.get(user_id, []):
+        change_log.record(match_id, user_id)
+
+
+def mark_chat_read(reader_id: int, sender_id: int):
+    chat_id = get_chat_id(reader_id, sender_id)
+    changed = False
+    for msg in messages_db.get(chat_id, []):
+        if msg["receiver_id"] == reader_id and not msg["is_read"]:
+            msg["is_read"] = True
+            changed = True
+    if changed:
+        change_log.record_pair(reader_id, sender_id)
+
+
+def sync_response(current_id: int, endpoint: str, since: Optional[str], if_none_match: Optional[str], build_entry, sort_key=None):
+    """Полный список или только изменения после курсора since; 304, если ETag совпал.
+
+    Курсор сдвигают все изменения, видимые в ответах, включая онлайн-статус собеседников
+    и смену их ячейки геолокации, поэтому ETag достаточно одного курсора.
+    """
+    cursor = change_log.cursor(current_id)
+    etag = f'"{endpoint}-{cursor}"'
+    headers = {"ETag": etag, "X-Sync-Cursor": cursor}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+
+    version = change_log.parse_cursor(since) if since else None
+    changed = change_log.changed_since(current_id, version) if version is not None else None
+    if changed is None or SELF in changed:
+        entries = [e for e in (build_entry(match_id) for match_id in matches_db.get(current_id, [])) if e]
+        if sort_key:
+            entries.sort(key=sort_key, reverse=True)
+        if since is None:
+            return JSONResponse(entries, headers=headers)
+        return JSONResponse({"cursor": cursor, "full": True, "items": entries, "removed": []}, headers=headers)
+
+    items, removed = [], []
+    for peer_id in changed:
+        entry = build_entry(peer_id) if peer_id in matches_db.get(current_id, []) else None
+        if entry:
+            items.append(entry)
+        else:
+            removed.append(peer_id)
+    if sort_key:
+        items.sort(key=sort_key, reverse=True)
+    return JSONResponse({"cursor": cursor, "full": False, "items": items, "removed": removed}, headers=headers)
+
+
 # ==================== НАСТРОЙКИ ====================
 
 @app.get("/settings")
@@ -193,6 +397,7 @@ def update_settings(settings: SettingsUpdate, current_user: dict = Depends(get_c
     if settings.show_distance is not None:
         settings_db[user_id]["show_distance"] = settings.show_distance
     
+    state_log.append(("settings", user_id, dict(settings_db[user_id])))
     return {"status": "ok"}
 
 
@@ -215,6 +420,8 @@ def block_user(user_id: int, current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=400, detail="User already blocked")
     
     blocks_db[current_id].append(user_id)
+    state_log.append(("block", current_id, user_id))
+    change_log.record_pair(current_id, user_id)
     return {"status": "ok", "message": "User blocked"}
 
 
@@ -226,6 +433,8 @@ def unblock_user(user_id: int, current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=404, detail="Block not found")
     
     blocks_db[current_id].remove(user_id)
+    state_log.append(("unblock", current_id, user_id))
+    change_log.record_pair(current_id, user_id)
     return {"status": "ok", "message": "User unblocked"}
 
 
@@ -259,13 +468,15 @@ def report_user(report: ReportCreate, current_user: dict = Depends(get_current_u
     if report.user_id not in users_db:
         raise HTTPException(status_code=404, detail="User not found")
     
-    reports_db.append({
+    new_report = {
         "reporter_id": current_id,
         "reported_id": report.user_id,
         "reason": report.reason,
         "description": report.description,
         "timestamp": datetime.now().isoformat()
-    })
+    }
+    reports_db.append(new_report)
+    state_log.append(("report", new_report))
     
     return {"status": "ok", "message": "Report submitted"}
 
@@ -285,28 +496,87 @@ def delete_account(current_user: dict = Depends(get_current_user)):
     # Удаляем из блокировок
     if current_id in blocks_db:
         del blocks_db[current_id]
+        state_log.append(("blocks_clear", current_id))
     
     # Удаляем токены
     tokens_to_remove = [t for t, u in tokens_db.items() if u["id"] == current_id]
     for t in tokens_to_remove:
         del tokens_db[t]
+        state_log.append(("token_del", t))
+
+    record_profile_change(current_id)
     
     return {"status": "ok", "message": "Account deleted"}
 
 
 # ==================== ГЕОЛОКАЦИЯ ====================
 
+LOCATION_MIN_INTERVAL = 5  # секунд между обновлениями производных структур
+LOCATION_MIN_MOVE_KM = 0.05  # меньшие сдвиги считаем шумом GPS
+LOCATION_CELL_DEGREES = 0.01  # ~1 км; производные структуры обновляем только при смене ячейки
+LOCATION_FLUSH_INTERVAL = 30  # секунд между записями в БД
+
+location_derived_at = {}  # {user_id: monotonic time последнего обновления производных структур}
+location_cells = {}  # {user_id: ячейка, по которой последний раз обновляли производные структуры}
+pending_locations = {}  # {user_id: (latitude, longitude, show_location)} — ждут записи в БД
+
+
+def location_cell(lat: Optional[float], lon: Optional[float]):
+    if lat is None or lon is None:
+        return None
+    return (math.floor(lat / LOCATION_CELL_DEGREES), math.floor(lon / LOCATION_CELL_DEGREES))
+
+
+def flush_locations():
+    batch = []
+    for user_id in list(pending_locations):
+        location = pending_locations.pop(user_id, None)
+        if location is not None:
+            batch.append((user_id, *location))
+    if batch and not update_locations(batch):
+        # Возвращаем в очередь, если за это время не пришла более новая точка
+        for user_id, lat, lon, show in batch:
+            pending_locations.setdefault(user_id, (lat, lon, show))
+
+
+def publish_location_cell(user_id: int, cell, published_cell, force: bool = False):
+    """Обновляет производные структуры, если ячейка сменилась и окно троттлинга прошло.
+
+    Смена ячейки внутри окна откладывается до следующего обновления локации после окна,
+    в том числе обновления без сдвига; если их больше не будет, она не публикуется.
+    """
+    now = time.monotonic()
+    throttled = now - location_derived_at.get(user_id, 0) < LOCATION_MIN_INTERVAL
+    if force or (not throttled and cell != published_cell):
+        location_derived_at[user_id] = now
+        location_cells[user_id] = cell
+        record_profile_change(user_id)
+
+
 @app.put("/location")
 def update_location(location: LocationUpdate, current_user: dict = Depends(get_current_user)):
     user_id = current_user["id"]
-    users_db[user_id]["latitude"] = location.latitude
-    users_db[user_id]["longitude"] = location.longitude
-    users_db[user_id]["show_location"] = location.show_location
-    for token, user in tokens_db.items():
-        if user["id"] == user_id:
-            tokens_db[token]["latitude"] = location.latitude
-            tokens_db[token]["longitude"] = location.longitude
-            tokens_db[token]["show_location"] = location.show_location
+    # tokens_db хранит ссылки на те же словари, что и users_db, поэтому достаточно обновить users_db
+    user = users_db[user_id]
+    old_lat, old_lon = user.get("latitude"), user.get("longitude")
+    visibility_changed = location.show_location != user.get("show_location", True)
+
+    published_cell = location_cells.get(user_id, location_cell(old_lat, old_lon))
+
+    if not visibility_changed and old_lat is not None and old_lon is not None:
+        if calculate_distance(old_lat, old_lon, location.latitude, location.longitude) < LOCATION_MIN_MOVE_KM:
+            # Точка не изменилась, но смена ячейки, пропущенная в окне троттлинга, публикуется здесь
+            publish_location_cell(user_id, location_cell(old_lat, old_lon), published_cell)
+            return {"status": "location_unchanged"}
+
+    # Последнюю точку сохраняем всегда: частые обновления схлопываются в pending_locations
+    user["latitude"] = location.latitude
+    user["longitude"] = location.longitude
+    user["show_location"] = location.show_location
+    pending_locations[user_id] = (location.latitude, location.longitude, location.show_location)
+
+    publish_location_cell(user_id, location_cell(location.latitude, location.longitude), published_cell,
+                          force=visibility_changed)
     return {"status": "location_updated"}
 
 
@@ -334,6 +604,7 @@ async def upload_profile_photo(file: UploadFile = File(...), current_user: dict
     for token, user in tokens_db.items():
         if user["id"] == current_user["id"]:
             tokens_db[token]["photo"] = photo_url
+    record_profile_change(current_user["id"])
     return {"photo_url": photo_url}
 
 
@@ -346,30 +617,25 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
     await websocket.accept()
     active_connections[user_id] = websocket
     user_status[user_id] = {"online": True, "last_seen": datetime.now().isoformat()}
+    state_log.append(("status", user_id, dict(user_status[user_id])))
+    record_presence_change(user_id)
     try:
         while True:
             data = await websocket.receive_json()
             if data["type"] == "message":
                 receiver_id = data["receiver_id"]
-                chat_id = get_chat_id(user_id, receiver_id)
-                if chat_id not in messages_db:
-                    messages_db[chat_id] = []
-                new_message = {
-                    "id": len(messages_db[chat_id]) + 1,
-                    "sender_id": user_id, "receiver_id": receiver_id,
-                    "text": data.get("text", ""), "image_url": data.get("image_url"),
-                    "timestamp": datetime.now().isoformat(), "is_read": False, "deleted": False
-                }
-                messages_db[chat_id].append(new_message)
+                try:
+                    check_rate_limit(message_limiter, user_id, "send_message")
+                except HTTPException as e:
+                    await send_ws_message(user_id, {"type": "error", "detail": e.detail, "retry_after": int(e.headers["Retry-After"])})
+                    continue
+                new_message = add_message(user_id, receiver_id, data.get("text", ""), data.get("image_url"))
                 await send_ws_message(receiver_id, {"type": "new_message", "message": new_message})
                 await send_ws_message(user_id, {"type": "message_sent", "message": new_message})
             elif data["type"] == "typing":
                 await send_ws_message(data["receiver_id"], {"type": "typing", "user_id": user_id, "is_typing": data["is_typing"]})
             elif data["type"] == "read":
-                chat_id = get_chat_id(user_id, data["sender_id"])
-                for msg in messages_db.get(chat_id, []):
-                    if msg["receiver_id"] == user_id:
-                        msg["is_read"] = True
+                mark_chat_read(user_id, data["sender_id"])
                 await send_ws_message(data["sender_id"], {"type": "messages_read", "reader_id": user_id})
     except WebSocketDisconnect:
         pass
@@ -377,6 +643,8 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
         if user_id in active_connections:
             del active_connections[user_id]
         user_status[user_id] = {"online": False, "last_seen": datetime.now().isoformat()}
+        state_log.append(("status", user_id, dict(user_status[user_id])))
+        record_presence_change(user_id)
 
 
 @app.get("/user/{user_id}/status")
@@ -385,7 +653,8 @@ def get_user_status_endpoint(user_id: int, current_user: dict = Depends(get_curr
 
 
 @app.post("/register")
-def register(user: UserRegister):
+def register(user: UserRegister, request: Request):
+    check_rate_limit(register_limiter, request.client.host if request.client else None, "register")
     if user.email in [u["email"] for u in users_db.values()]:
         raise HTTPException(status_code=400, detail="Email already registered")
 
@@ -404,6 +673,7 @@ def register(user: UserRegister):
 
     token = f"token_{user_id}_{datetime.now().timestamp()}"
     tokens_db[token] = user_data
+    state_log.append(("token", token, user_id))
     return {"token": token, "user": user_data}
 
 
@@ -413,6 +683,7 @@ def login(user: UserLogin):
         if u["email"] == user.email and u["password"] == user.password:
             token = f"token_{u['id']}_{datetime.now().timestamp()}"
             tokens_db[token] = u
+            state_log.append(("token", token, u["id"]))
             return {"token": token, "user": u}
     raise HTTPException(status_code=401, detail="Invalid email or password")
 
@@ -433,6 +704,7 @@ def update_profile(user_update: UserUpdate, current_user: dict = Depends(get_cur
     for token, user in tokens_db.items():
         if user["id"] == user_id:
             tokens_db[token] = users_db[user_id]
+    record_profile_change(user_id)
     return users_db[user_id]
 
 
@@ -441,6 +713,7 @@ def get_profiles(current_user: dict = Depends(get_current_user), max_distance: O
     current_id = current_user["id"]
     my_interests = set(current_user.get("interests") or [])
     my_likes = likes_db.get(current_id, [])
+    my_skips = skips_db.get(current_id, set())
     my_lat = current_user.get("latitude")
     my_lon = current_user.get("longitude")
     my_blocked = blocks_db.get(current_id, [])
@@ -448,7 +721,7 @@ def get_profiles(current_user: dict = Depends(get_current_user), max_distance: O
     profiles = []
     for user in users_db.values():
         # Пропускаем себя, уже лайкнутых и заблокированных
-        if user["id"] == current_id or user["id"] in my_likes or user["id"] in my_blocked:
+        if user["id"] == current_id or user["id"] in my_likes or user["id"] in my_skips or user["id"] in my_blocked:
             continue
         
         # Пропускаем если нас заблокировал этот пользователь
@@ -487,19 +760,26 @@ def get_profiles(current_user: dict = Depends(get_current_user), max_distance: O
     return profiles
 
 
-@app.post("/like/{user_id}")
-async def like_user(user_id: int, current_user: dict = Depends(get_current_user)):
-    current_id = current_user["id"]
-    if user_id not in users_db:
-        raise HTTPException(status_code=404, detail="User not found")
+def public_profile(user: dict) -> dict:
+    return {
+        "id": user["id"], "name": user["name"], "age": user.get("age"),
+        "city": user.get("city"), "photo": user.get("photo")
+    }
+
 
+def apply_like(current_id: int, user_id: int):
+    """Обновляет лайки и мэтчи в памяти. Возвращает (новый лайк, есть мэтч, новый мэтч)."""
     if current_id not in likes_db:
         likes_db[current_id] = []
-    if user_id not in likes_db[current_id]:
+    likers = liked_by_db.setdefault(user_id, {})
+    is_new_like = current_id not in likers
+    if is_new_like:
         likes_db[current_id].append(user_id)
-        save_like(current_id, user_id)
+        likers[current_id] = None
+        skips_db.get(current_id, set()).discard(user_id)
 
-    is_match = user_id in likes_db and current_id in likes_db.get(user_id, [])
+    is_match = user_id in liked_by_db.get(current_id, {})
+    is_new_match = False
     if is_match:
         if current_id not in matches_db:
             matches_db[current_id] = []
@@ -508,47 +788,164 @@ async def like_user(user_id: int, current_user: dict = Depends(get_current_user)
         if user_id not in matches_db[current_id]:
             matches_db[current_id].append(user_id)
             matches_db[user_id].append(current_id)
-            save_match(current_id, user_id)
+            change_log.record_pair(current_id, user_id)
+            is_new_match = True
+    return is_new_like, is_match, is_new_match
+
+
+def apply_skip(current_id: int, user_id: int) -> bool:
+    """Запоминает пропуск. Уже лайкнутого пропуск не отменяет."""
+    if current_id in liked_by_db.get(user_id, {}):
+        return False
+    my_skips = skips_db.setdefault(current_id, set())
+    if user_id in my_skips:
+        return False
+    my_skips.add(user_id)
+    return True
+
+
+@app.post("/like/{user_id}")
+async def like_user(user_id: int, current_user: dict = Depends(get_current_user)):
+    current_id = current_user["id"]
+    check_rate_limit(like_limiter, current_id, "like_user")
+    if user_id not in users_db:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    is_new_like, is_match, is_new_match = apply_like(current_id, user_id)
+    if is_new_like:
+        save_like(current_id, user_id)
+    if is_new_match:
+        save_match(current_id, user_id)
+    if is_match:
         await send_ws_message(user_id, {"type": "new_match", "user": {"id": current_id, "name": current_user["name"], "photo": current_user.get("photo")}})
 
     return {"status": "liked", "is_match": is_match, "matched_user": users_db[user_id] if is_match else None}
 
 
+@app.get("/likes/received")
+def get_received_likes(current_user: dict = Depends(get_current_user),
+                       offset: int = Query(0, ge=0), limit: int = Query(20, ge=1, le=100)):
+    current_id = current_user["id"]
+    my_blocked = blocks_db.get(current_id, [])
+    my_matches = set(matches_db.get(current_id, []))
+    my_skips = skips_db.get(current_id, set())
+
+    # Новые лайки первыми; взаимные уже в /matches, пропущенных не показываем
+    pending = [
+        uid for uid in reversed(liked_by_db.get(current_id, {}))
+        if uid not in my_matches and uid not in my_skips and uid not in my_blocked
+        and current_id not in blocks_db.get(uid, []) and uid in users_db
+    ]
+
+    items = [public_profile(users_db[uid]) for uid in pending[offset:offset + limit]]
+    return {"total": len(pending), "offset": offset, "limit": limit, "items": items}
+
+
 @app.post("/skip/{user_id}")
 def skip_user(user_id: int, current_user: dict = Depends(get_current_user)):
+    current_id = current_user["id"]
+    if user_id not in users_db:
+        raise HTTPException(status_code=404, detail="User not found")
+    if apply_skip(current_id, user_id):
+        save_like(current_id, user_id, is_like=False)
     return {"status": "skipped"}
 
 
+@app.post("/swipes")
+async def batch_swipes(batch: SwipeBatch, current_user: dict = Depends(get_current_user)):
+    current_id = current_user["id"]
+    if len(batch.swipes) > MAX_SWIPES_PER_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SWIPES_PER_BATCH} swipes per batch")
+
+    # Каждый лайк в пакете стоит токен, как и отдельный /like. Применяем пакет до первого
+    # лайка, на который токена не хватило; остаток клиент отправит повторно после Retry-After
+    like_count = sum(1 for swipe in batch.swipes if swipe.action == "like")
+    allowed_likes, retry_after = like_limiter.take_up_to(current_id, like_count)
+
+    results = []
+    new_swipes = []
+    new_matches = []
+    matched_ids = []
+    likes_used = 0
+    for i, swipe in enumerate(batch.swipes):
+        if swipe.action == "like" and likes_used == allowed_likes:
+            for rest in batch.swipes[i:]:
+                results.append({"user_id": rest.user_id, "status": "rate_limited", "is_match": False})
+            shed_counters["rate_limit:like_user"] += 1
+            break
+        if swipe.action == "like":
+            likes_used += 1
+        user_id = swipe.user_id
+        if user_id not in users_db or user_id == current_id:
+            results.append({"user_id": user_id, "status": "not_found", "is_match": False})
+            continue
+        if swipe.action == "skip":
+            if apply_skip(current_id, user_id):
+                new_swipes.append((current_id, user_id, False))
+            results.append({"user_id": user_id, "status": "skipped", "is_match": False})
+            continue
+        is_new_like, is_match, is_new_match = apply_like(current_id, user_id)
+        if is_new_like:
+            new_swipes.append((current_id, user_id, True))
+        if is_new_match:
+            new_matches.append((current_id, user_id))
+        if is_match and user_id not in matched_ids:
+            matched_ids.append(user_id)
+        results.append({"user_id": user_id, "status": "liked", "is_match": is_match})
+
+    if new_swipes or new_matches:
+        await asyncio.to_thread(save_swipes, new_swipes, new_matches)
+
+    notification = {"type": "new_match", "user": {"id": current_id, "name": current_user["name"], "photo": current_user.get("photo")}}
+    await asyncio.gather(*(send_ws_message(uid, notification) for uid in matched_ids))
+
+    response = {"results": results, "matches": [public_profile(users_db[uid]) for uid in matched_ids]}
+    if likes_used < like_count:
+        return JSONResponse(response, status_code=429, headers={"Retry-After": str(max(1, round(retry_after)))})
+    return response
+
+
 @app.get("/matches")
-def get_matches(current_user: dict = Depends(get_current_user)):
+def get_matches(current_user: dict = Depends(get_current_user), since: Optional[str] = Query(None),
+                if_none_match: Optional[str] = Header(None)):
     current_id = current_user["id"]
     my_lat = current_user.get("latitude")
     my_lon = current_user.get("longitude")
     my_blocked = blocks_db.get(current_id, [])
 
-    matches = []
-    for match_id in matches_db.get(current_id, []):
+    def build_entry(match_id):
         # Пропускаем заблокированных
         if match_id in my_blocked or current_id in blocks_db.get(match_id, []):
-            continue
-            
-        if match_id in users_db:
-            user = users_db[match_id]
-            chat_id = get_chat_id(current_id, match_id)
-            chat_messages = [m for m in messages_db.get(chat_id, []) if not m.get("deleted")]
-            status = user_status.get(match_id, {"online": False, "last_seen": None})
-            distance = None
-            if my_lat and my_lon and user.get("latitude") and user.get("longitude") and user.get("show_location", True):
-                distance = round(calculate_distance(my_lat, my_lon, user["latitude"], user["longitude"]), 1)
-            matches.append({
-                "id": user["id"], "name": user["name"], "age": user.get("age"),
-                "city": user.get("city"), "bio": user.get("bio"),
-                "interests": user.get("interests", []),
-                "last_message": chat_messages[-1] if chat_messages else None,
-                "online": status["online"], "last_seen": status.get("last_seen"),
-                "photo": user.get("photo"), "distance": distance
-            })
-    return matches
+            return None
+        if match_id not in users_db:
+            return None
+        user = users_db[match_id]
+        chat_id = get_chat_id(current_id, match_id)
+        chat_messages = [m for m in messages_db.get(chat_id, []) if not m.get("deleted")]
+        status = user_status.get(match_id, {"online": False, "last_seen": None})
+        distance = None
+        if my_lat and my_lon and user.get("latitude") and user.get("longitude") and user.get("show_location", True):
+            distance = round(calculate_distance(my_lat, my_lon, user["latitude"], user["longitude"]), 1)
+        return {
+            "id": user["id"], "name": user["name"], "age": user.get("age"),
+            "city": user.get("city"), "bio": user.get("bio"),
+            "interests": user.get("interests", []),
+            "last_message": chat_messages[-1] if chat_messages else None,
+            "online": status["online"], "last_seen": status.get("last_seen"),
+            "photo": user.get("photo"), "distance": distance
+        }
+
+    return sync_response(current_id, "matches", since, if_none_match, build_entry)
+
+
+@app.get("/chat/search")
+def search_messages(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100),
+                    current_user: dict = Depends(get_current_user)):
+    current_id = current_user["id"]
+    # Переписки с заблокированными не показываем, как и в /chats
+    hidden = set(blocks_db.get(current_id, []))
+    hidden.update(uid for uid in matches_db.get(current_id, []) if current_id in blocks_db.get(uid, []))
+    return message_index.search(current_id, q, limit=limit, exclude_peers=hidden)
 
 
 @app.get("/chat/{user_id}/messages")
@@ -558,28 +955,17 @@ def get_messages(user_id: int, current_user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="You can only chat with matches")
     chat_id = get_chat_id(current_id, user_id)
     messages = [m for m in messages_db.get(chat_id, []) if not m.get("deleted")]
-    for msg in messages:
-        if msg["receiver_id"] == current_id:
-            msg["is_read"] = True
+    mark_chat_read(current_id, user_id)
     return messages
 
 
 @app.post("/chat/{user_id}/send")
 def send_message(user_id: int, message: MessageSend, current_user: dict = Depends(get_current_user)):
     current_id = current_user["id"]
+    check_rate_limit(message_limiter, current_id, "send_message")
     if user_id not in matches_db.get(current_id, []):
         raise HTTPException(status_code=403, detail="You can only chat with matches")
-    chat_id = get_chat_id(current_id, user_id)
-    if chat_id not in messages_db:
-        messages_db[chat_id] = []
-    new_message = {
-        "id": len(messages_db[chat_id]) + 1,
-        "sender_id": current_id, "receiver_id": user_id,
-        "text": message.text, "image_url": message.image_url,
-        "timestamp": datetime.now().isoformat(), "is_read": False, "deleted": False
-    }
-    messages_db[chat_id].append(new_message)
-    return new_message
+    return add_message(current_id, user_id, message.text, message.image_url)
 
 
 @app.delete("/chat/{user_id}/message/{message_id}")
@@ -590,34 +976,42 @@ def delete_message(user_id: int, message_id: int, current_user: dict = Depends(g
     for msg in messages_db.get(chat_id, []):
         if msg["id"] == message_id and msg["sender_id"] == current_id:
             msg["deleted"] = True
+            message_index.remove(msg)
+            change_log.record_pair(current_id, user_id)
             return {"status": "ok"}
     
     raise HTTPException(status_code=404, detail="Message not found")
 
 
 @app.get("/chats")
-def get_chats(current_user: dict = Depends(get_current_user)):
+def get_chats(current_user: dict = Depends(get_current_user), since: Optional[str] = Query(None),
+              if_none_match: Optional[str] = Header(None)):
     current_id = current_user["id"]
     my_blocked = blocks_db.get(current_id, [])
-    
-    chats = []
-    for match_id in matches_db.get(current_id, []):
+
+    def build_entry(match_id):
         # Пропускаем заблокированных
         if match_id in my_blocked or current_id in blocks_db.get(match_id, []):
-            continue
-            
-        if match_id in users_db:
-            user = users_db[match_id]
-            chat_id = get_chat_id(current_id, match_id)
-            chat_messages = [m for m in messages_db.get(chat_id, []) if not m.get("deleted")]
-            unread = sum(1 for m in chat_messages if m["receiver_id"] == current_id and not m["is_read"])
-            chats.append({
-                "user_id": user["id"], "user_name": user["name"],
-                "last_message": chat_messages[-1] if chat_messages else None,
-                "unread_count": unread, "photo": user.get("photo")
-            })
-    chats.sort(key=lambda x: x["last_message"]["timestamp"] if x["last_message"] else "", reverse=True)
-    return chats
+            return None
+        if match_id not in users_db:
+            return None
+        user = users_db[match_id]
+        chat_id = get_chat_id(current_id, match_id)
+        chat_messages = [m for m in messages_db.get(chat_id, []) if not m.get("deleted")]
+        unread = sum(1 for m in chat_messages if m["receiver_id"] == current_id and not m["is_read"])
+        return {
+            "user_id": user["id"], "user_name": user["name"],
+            "last_message": chat_messages[-1] if chat_messages else None,
+            "unread_count": unread, "photo": user.get("photo")
+        }
+
+    return sync_response(current_id, "chats", since, if_none_match, build_entry,
+                         sort_key=lambda x: x["last_message"]["timestamp"] if x["last_message"] else "")
+
+
+@app.get("/admission/stats", dependencies=[Depends(require_admin)])
+def get_admission_stats():
+    return {"shed": dict(shed_counters), "total_shed": sum(shed_counters.values())}
 
 
 @app.get("/")
@@ -0,0 +1,153 @@
+﻿import os
+import sys
+import asyncio
+import contextvars
+import time
+import random
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+from fastapi import FastAPI, Depends, Query
+from app.admin import ADMIN_TOKEN, is_admin_token, require_admin
+
+# Профилирование включается только если задан токен администратора или частота выборки.
+# Без них middleware не устанавливается вовсе и на запросы никак не влияет.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_HEADER = b"x-profile"
+ADMIN_HEADER = b"x-admin-token"
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+profile_window = {"until": 0.0}
+
+# Контекст запроса копируется в поток пула, поэтому mark_profiled_thread видит сэмплер своего запроса
+profiled_request = contextvars.ContextVar("profiled_request", default=None)
+
+
+class StackSampler:
+    """Периодически снимает стек потока, который сейчас выполняет профилируемый запрос.
+
+    В потоке event loop это кадры под корутиной запроса (root_frame), остальные
+    запросы и простой цикла не попадают. Поток пула запрос сообщает сам через
+    mark_profiled_thread; из него берутся только стеки, где выполняется код приложения.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = Counter()
+        self.loop_thread_id = None
+        self.root_frame = None
+        self.worker_thread_id = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self, root_frame):
+        self.loop_thread_id = threading.get_ident()
+        self.root_frame = root_frame
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self, thread_id, frame, names):
+        frames = []
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        if thread_id == self.loop_thread_id:
+            if not any(f is self.root_frame for f in frames):
+                return
+        elif not any(f.f_code.co_filename.startswith(APP_DIR) for f in frames):
+            # Поток пула простаивает между вызовами зависимостей и обработчика
+            return
+        stack = [f"{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{f.f_lineno})" for f in frames]
+        stack.append(names.get(thread_id, f"thread-{thread_id}"))
+        self.samples[";".join(reversed(stack))] += 1
+
+    def _run(self):
+        names = {}
+        while not self._stop.wait(self.interval):
+            current = sys._current_frames()
+            for thread_id in (self.loop_thread_id, self.worker_thread_id):
+                frame = current.get(thread_id)
+                if frame is None:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                self._sample(thread_id, frame, names)
+
+    def write_collapsed(self, route: str) -> Optional[str]:
+        if not self.samples:
+            return None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        tag = route.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "root"
+        filename = f"{tag}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.folded"
+        path = os.path.join(PROFILE_DIR, filename)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.items():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+class ProfilingMiddleware:
+    """Профилирует запрос, если его запросил администратор (X-Profile вместе с X-Admin-Token),
+    если запрос попал в выборку PROFILE_SAMPLE_RATE или если открыто окно профилирования."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def should_profile(self, scope) -> bool:
+        if profile_window["until"] and time.monotonic() < profile_window["until"]:
+            return True
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            return True
+        if ADMIN_TOKEN:
+            headers = dict(scope.get("headers", []))
+            if PROFILE_HEADER in headers and ADMIN_HEADER in headers:
+                return is_admin_token(headers[ADMIN_HEADER].decode("latin-1"))
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        sampler = StackSampler(PROFILE_INTERVAL)
+        token = profiled_request.set(sampler)
+        sampler.start(sys._getframe())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiled_request.reset(token)
+            await asyncio.to_thread(sampler.stop)
+            route = getattr(scope.get("route"), "path", None) or scope["path"]
+            path = await asyncio.to_thread(sampler.write_collapsed, route)
+            if path:
+                print(f"Profile for {scope['method']} {route} written to {path}")
+
+
+def mark_profiled_thread():
+    # Sync-зависимость выполняется в потоке пула; тот же поток затем обычно берёт и обработчик
+    sampler = profiled_request.get()
+    if sampler is not None:
+        sampler.worker_thread_id = threading.get_ident()
+
+
+def install_profiler(app: FastAPI):
+    """Вызывается до объявления маршрутов, чтобы mark_profiled_thread попала в каждый из них."""
+    if not ADMIN_TOKEN and not PROFILE_SAMPLE_RATE:
+        return
+
+    app.add_middleware(ProfilingMiddleware)
+    app.router.dependencies.append(Depends(mark_profiled_thread))
+
+    if not ADMIN_TOKEN:
+        return
+
+    @app.post("/admin/profile", dependencies=[Depends(require_admin)])
+    def start_profile_window(seconds: int = Query(30, ge=1, le=600)):
+        profile_window["until"] = time.monotonic() + seconds
+        return {"status": "ok", "profiling_seconds": seconds, "output_dir": PROFILE_DIR}
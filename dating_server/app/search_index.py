@@ -0,0 +1,99 @@
+﻿import re
+import math
+import heapq
+import itertools
+import threading
+from collections import Counter
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list:
+    # \w в Python понимает Unicode, casefold приводит регистр и для кириллицы; ё и е не различаем
+    return WORD_RE.findall((text or "").casefold().replace("ё", "е"))
+
+
+class MessageIndex:
+    """Инвертированный индекс по сообщениям, отдельный для каждого пользователя.
+
+    Сообщение индексируется у отправителя и у получателя, поэтому поиск
+    затрагивает только переписки самого пользователя.
+    """
+
+    def __init__(self):
+        self.postings = {}  # {user_id: {token: {(peer_id, message_id): tf}}}
+        self.docs = {}  # {user_id: {(peer_id, message_id): (seq, message)}}
+        self._seq = itertools.count()  # порядок добавления; дешевле сравнивать, чем timestamp
+        self._lock = threading.Lock()
+
+    def add(self, message: dict):
+        counts = Counter(tokenize(message.get("text")))
+        if not counts:
+            return
+        sender_id, receiver_id = message["sender_id"], message["receiver_id"]
+        with self._lock:
+            seq = next(self._seq)
+            for user_id, peer_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+                key = (peer_id, message["id"])
+                self.docs.setdefault(user_id, {})[key] = (seq, message)
+                user_postings = self.postings.setdefault(user_id, {})
+                for token, tf in counts.items():
+                    user_postings.setdefault(token, {})[key] = tf
+
+    def remove(self, message: dict):
+        tokens = set(tokenize(message.get("text")))
+        sender_id, receiver_id = message["sender_id"], message["receiver_id"]
+        with self._lock:
+            for user_id, peer_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+                key = (peer_id, message["id"])
+                self.docs.get(user_id, {}).pop(key, None)
+                user_postings = self.postings.get(user_id, {})
+                for token in tokens:
+                    posting = user_postings.get(token)
+                    if posting is None:
+                        continue
+                    posting.pop(key, None)
+                    if not posting:
+                        del user_postings[token]
+
+    def search(self, user_id: int, query: str, limit: int = 20, exclude_peers=()) -> list:
+        """Сообщения, содержащие все слова запроса, по убыванию TF-IDF, при равенстве — новые первыми."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        # Под блокировкой только копируем списки (быстро, на C); пересечение и ранжирование
+        # идут без неё, чтобы поиск не задерживал add из WebSocket-обработчика
+        with self._lock:
+            user_postings = self.postings.get(user_id, {})
+            postings = [user_postings.get(t) for t in terms]
+            if not all(postings):
+                return []
+            postings = [dict(p) for p in postings]
+            total = len(self.docs.get(user_id, {}))
+            docs = self.docs.get(user_id, {})
+
+        # Пересекаем начиная с самого короткого списка
+        postings.sort(key=len)
+        candidates = postings[0].keys()
+        if exclude_peers:
+            candidates = [k for k in candidates if k[0] not in exclude_peers]
+        for posting in postings[1:]:
+            candidates = [k for k in candidates if k in posting]
+            if not candidates:
+                return []
+        idf = [math.log(1 + total / len(p)) for p in postings]
+        # Сообщение могли удалить после копирования: такие ставим в конец и отбрасываем
+        missing = (-1, None)
+        if len(postings) == 1:
+            posting, weight = postings[0], idf[0]
+            top = heapq.nlargest(limit, candidates, key=lambda k: (posting[k], docs.get(k, missing)[0]))
+            hits = [(posting[k] * weight, k) for k in top]
+        else:
+            scored = ((sum(p[k] * w for p, w in zip(postings, idf)), docs.get(k, missing)[0], k) for k in candidates)
+            hits = [(score, k) for score, _, k in heapq.nlargest(limit, scored)]
+        results = []
+        for score, (peer_id, message_id) in hits:
+            doc = docs.get((peer_id, message_id))
+            if doc is not None:
+                results.append({"user_id": peer_id, "message_id": message_id, "score": round(score, 3), "message": doc[1]})
+        return results
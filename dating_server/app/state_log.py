@@ -0,0 +1,152 @@
+﻿import os
+import queue
+import pickle
+import struct
+import threading
+
+STATE_DIR = os.environ.get("STATE_DIR", "state")
+SNAPSHOT_INTERVAL = int(os.environ.get("STATE_SNAPSHOT_INTERVAL", "300"))
+
+RECORD_HEADER = struct.Struct(">I")
+
+
+class StateLog:
+    """Журнал операций над состоянием, которое живёт только в памяти.
+
+    Операции дописываются в state.log фоновым потоком, поэтому запрос никогда не ждёт диска.
+    Периодически текущее состояние сохраняется в state.snapshot, а журнал обрезается.
+    При старте читается снимок и хвост журнала после него.
+    """
+
+    def __init__(self, directory: str = STATE_DIR):
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, "state.snapshot")
+        self.log_path = os.path.join(directory, "state.log")
+        self.seq = 0
+        self.snapshot_seq = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def load(self, restore_snapshot, apply_op):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                self.snapshot_seq, state = pickle.load(f)
+            restore_snapshot(state)
+        self.seq = self.snapshot_seq
+
+        replayed = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r+b") as f:
+                good_offset = 0
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    body = f.read(RECORD_HEADER.unpack(header)[0])
+                    try:
+                        seq, op = pickle.loads(body)
+                    except Exception:
+                        break
+                    good_offset = f.tell()
+                    if seq <= self.snapshot_seq:
+                        continue
+                    apply_op(op)
+                    self.seq = seq
+                    replayed += 1
+                # Обрезаем недописанную при падении запись, чтобы новые не легли после мусора
+                f.truncate(good_offset)
+        print(f"Restored state: snapshot seq {self.snapshot_seq}, {replayed} log records replayed")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="state-log", daemon=True)
+        self._thread.start()
+
+    def append(self, op: tuple):
+        with self._lock:
+            self.seq += 1
+            self._queue.put(("op", self.seq, op))
+
+    def snapshot(self, capture_state):
+        # Снимок и номер берутся под той же блокировкой, что и append,
+        # поэтому порядок в очереди совпадает с порядком номеров
+        with self._lock:
+            if self.seq == self.snapshot_seq:
+                return
+            # Номер снимка сдвигаем только после успешного копирования, иначе при ошибке
+            # следующие снимки пропускались бы как ненужные
+            state = capture_state()
+            previous_seq = self.snapshot_seq
+            self.snapshot_seq = self.seq
+            self._queue.put(("snapshot", self.seq, (state, previous_seq)))
+
+    def close(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        # Ошибки диска логируем и продолжаем: если поток умрёт, очередь будет расти,
+        # а состояние перестанет сохраняться до рестарта
+        log = open(self.log_path, "ab")
+        try:
+            stopping = False
+            while not stopping:
+                items = [self._queue.get()]
+                while True:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for item in items:
+                    if item is None:
+                        stopping = True
+                        break
+                    kind, seq, payload = item
+                    if kind == "op":
+                        self._write_op(log, seq, payload)
+                    else:
+                        state, previous_seq = payload
+                        try:
+                            log.flush()
+                            self._write_snapshot(seq, state)
+                        except Exception as e:
+                            # Старый журнал остаётся, снимок повторится на следующем интервале
+                            print(f"Error writing state snapshot: {e}")
+                            with self._lock:
+                                if self.snapshot_seq == seq:
+                                    self.snapshot_seq = previous_seq
+                            continue
+                        log.close()
+                        log = open(self.log_path, "wb")
+                try:
+                    log.flush()
+                    os.fsync(log.fileno())
+                except Exception as e:
+                    print(f"Error syncing state log: {e}")
+        finally:
+            log.close()
+
+    def _write_op(self, log, seq: int, op: tuple):
+        body = pickle.dumps((seq, op), protocol=pickle.HIGHEST_PROTOCOL)
+        position = log.tell()
+        try:
+            log.write(RECORD_HEADER.pack(len(body)) + body)
+        except Exception as e:
+            print(f"Error writing state log: {e}")
+            # Не оставляем обрывок записи, иначе при загрузке всё после него отбросится
+            try:
+                log.seek(position)
+                log.truncate()
+            except Exception:
+                pass
+
+    def _write_snapshot(self, seq: int, state: dict):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((seq, state), f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
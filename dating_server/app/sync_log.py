@@ -0,0 +1,54 @@
+﻿import time
+import threading
+from typing import Optional
+
+SELF = None  # ключ изменения собственного профиля пользователя
+
+
+class ChangeLog:
+    """Версии изменений для дельта-синхронизации /matches и /chats.
+
+    Для каждого пользователя хранится {peer_id: версия последнего изменения},
+    упорядоченный по версии, поэтому изменения после курсора читаются за O(изменений).
+    Курсор содержит эпоху запуска: после рестарта старые курсоры ведут к полной синхронизации.
+    """
+
+    def __init__(self):
+        self.epoch = str(int(time.time()))
+        self.version = 0
+        self.log = {}  # {user_id: {peer_id: version}}
+        self._lock = threading.Lock()
+
+    def record(self, user_id: int, peer_id: Optional[int]):
+        with self._lock:
+            self.version += 1
+            changes = self.log.setdefault(user_id, {})
+            changes.pop(peer_id, None)
+            changes[peer_id] = self.version
+
+    def record_pair(self, user1_id: int, user2_id: int):
+        self.record(user1_id, user2_id)
+        self.record(user2_id, user1_id)
+
+    def user_version(self, user_id: int) -> int:
+        with self._lock:
+            changes = self.log.get(user_id)
+            return next(reversed(changes.values())) if changes else 0
+
+    def cursor(self, user_id: int) -> str:
+        return f"{self.epoch}.{self.user_version(user_id)}"
+
+    def parse_cursor(self, cursor: str) -> Optional[int]:
+        epoch, _, version = cursor.partition(".")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def changed_since(self, user_id: int, version: int) -> list:
+        with self._lock:
+            changed = []
+            for peer_id, peer_version in reversed(self.log.get(user_id, {}).items()):
+                if peer_version <= version:
+                    break
+                changed.append(peer_id)
+            return changed
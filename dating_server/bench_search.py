@@ -0,0 +1,44 @@
+﻿import random
+import statistics
+import time
+from app.search_index import MessageIndex
+
+# Синтетическая переписка: один пользователь, много чатов, смесь русских и английских слов
+USER_ID = 1
+CHATS = 200
+MESSAGES_PER_CHAT = 1000
+QUERIES = 200
+
+WORDS = (
+    "привет как дела что делаешь сегодня вечером кино кофе встретимся завтра погода "
+    "работа выходные море горы книга музыка концерт ужин прогулка парк город "
+    "hello how are you doing tonight movie coffee meet tomorrow weather work weekend "
+    "sea mountains book music concert dinner walk park city"
+).split()
+
+random.seed(42)
+index = MessageIndex()
+
+start = time.perf_counter()
+for peer_id in range(2, CHATS + 2):
+    for message_id in range(1, MESSAGES_PER_CHAT + 1):
+        sender, receiver = (USER_ID, peer_id) if message_id % 2 else (peer_id, USER_ID)
+        index.add({
+            "id": message_id, "sender_id": sender, "receiver_id": receiver,
+            "text": " ".join(random.choices(WORDS, k=random.randint(3, 15))).capitalize(),
+            "timestamp": f"2026-01-01T00:{message_id:06d}",
+        })
+build_time = time.perf_counter() - start
+total = CHATS * MESSAGES_PER_CHAT
+print(f"Indexed {total} messages in {build_time:.2f}s ({total / build_time:.0f} msg/s)")
+
+for terms in (1, 2, 3):
+    latencies = []
+    for _ in range(QUERIES):
+        query = " ".join(random.sample(WORDS, terms)).upper()
+        start = time.perf_counter()
+        index.search(USER_ID, query, limit=20)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    print(f"{terms}-word query: p50 {statistics.median(latencies):.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)]:.2f} ms")